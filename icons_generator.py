@@ -1,34 +1,56 @@
+import argparse
 import bpy
+import logging
 import math
 import mathutils
+import numpy as np
 import os
+import struct
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-object progress is logged at debug level, shown when running with --verbose
+logger = logging.getLogger(__name__)
 
 # Define the resolutions to render
 RESOLUTIONS = [1024, 512, 256, 128, 64]
 
+# Camera transform, in front of the origin and pointing towards it (adjust as needed)
+CAM_LOC = (0.0, -4.0, 0.0)
+CAM_ROT = (math.pi / 2, 0.0, 0.0)
+
+# Cycles GPU backends, in order of preference
+GPU_COMPUTE_DEVICE_TYPES = ('OPTIX', 'CUDA', 'HIP', 'METAL', 'ONEAPI')
+
+# Fast zlib level for the downscaled icons, slightly larger files in exchange for much faster encoding
+PNG_COMPRESS_LEVEL = 1
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
 import mathutils
 
-def scale_object_to_fit_camera(obj, target_size=2):
-    """Scale the object so that its front plane bounding box fits within the camera's view, with the largest side equal to `target_size`."""
+def get_world_bounds(obj, depsgraph=None):
+    """Return the min and max corners of the object's evaluated world-space bounding box."""
+    # Read the evaluated object (modifiers included) and copy its world matrix once
+    obj_eval = obj.evaluated_get(depsgraph or bpy.context.evaluated_depsgraph_get())
+    matrix = obj_eval.matrix_world.copy()
     
-    # Ensure we're in object mode
-    bpy.ops.object.mode_set(mode='OBJECT')
-
-    # Get the object's world-space bounding box corners
-    bounding_box = [obj.matrix_world @ mathutils.Vector(corner) for corner in obj.bound_box]
+    # Transform all eight homogeneous corners at once and reduce them in NumPy
+    corners = np.array([list(corner) + [1.0] for corner in obj_eval.bound_box])  # (8, 4)
+    world_corners = corners @ np.array(matrix).T                            # (8, 4)
     
-    # Get the min and max values for the bounding box
-    min_x = min(corner.x for corner in bounding_box)
-    max_x = max(corner.x for corner in bounding_box)
-    min_y = min(corner.y for corner in bounding_box)
-    max_y = max(corner.y for corner in bounding_box)
-    min_z = min(corner.z for corner in bounding_box)
-    max_z = max(corner.z for corner in bounding_box)
+    return world_corners[:, :3].min(axis=0), world_corners[:, :3].max(axis=0)
+
+def scale_object_to_fit_camera(obj, target_size=2, bounds=None):
+    """Scale the object so that its front plane bounding box fits within the camera's view, with the largest side equal to `target_size`.
+    `bounds` are the min and max world-space corners if already known, otherwise they are looked up with `get_world_bounds`."""
+
+    # Get the min and max corners of the object's world-space bounding box
+    bounds_min, bounds_max = bounds if bounds is not None else get_world_bounds(obj)
 
     # Calculate the width and height of the front-facing plane
-    width = max_x - min_x
-    depth = max_y - min_y  # Depending on the camera angle, this could be front or side
-    height = max_z - min_z
+    # Depending on the camera angle, depth could be front or side
+    width, depth, height = (bounds_max - bounds_min).tolist()
 
     # Determine which plane is facing the camera
     front_plane = "XY"  # Assume the front plane is the X-Y plane (this is a common case)
@@ -36,13 +58,13 @@ def scale_object_to_fit_camera(obj, target_size=2):
     # For a different camera angle, we might need additional checks to determine which plane is facing the camera.
     # For now, let's assume the front-facing plane is along the XY axis for simplicity.
 
-    print(f"Object bounding box dimensions - Width: {width}, Depth: {depth}, Height: {height}")
+    logger.debug("Object bounding box dimensions - Width: %s, Depth: %s, Height: %s", width, depth, height)
 
     if front_plane == "XY":
         # If the front plane is XY, determine the larger dimension (width vs. depth)
         largest_dimension = max(width, depth)
         scale_factor = target_size / largest_dimension
-        print(f"Scaling the object to fit the front plane XY. Largest dimension: {largest_dimension}. Scale factor: {scale_factor}")
+        logger.debug("Scaling the object to fit the front plane XY. Largest dimension: %s. Scale factor: %s", largest_dimension, scale_factor)
         # Apply the scale to the object
         obj.scale = (scale_factor, scale_factor, scale_factor)
     
@@ -50,7 +72,7 @@ def scale_object_to_fit_camera(obj, target_size=2):
         # If the front plane is YZ, then we'd scale based on height and depth
         largest_dimension = max(height, depth)
         scale_factor = target_size / largest_dimension
-        print(f"Scaling the object to fit the front plane YZ. Largest dimension: {largest_dimension}. Scale factor: {scale_factor}")
+        logger.debug("Scaling the object to fit the front plane YZ. Largest dimension: %s. Scale factor: %s", largest_dimension, scale_factor)
         # Apply the scale to the object
         obj.scale = (scale_factor, scale_factor, scale_factor)
     
@@ -58,48 +80,132 @@ def scale_object_to_fit_camera(obj, target_size=2):
         # If the front plane is ZX, scale based on height and width
         largest_dimension = max(width, height)
         scale_factor = target_size / largest_dimension
-        print(f"Scaling the object to fit the front plane ZX. Largest dimension: {largest_dimension}. Scale factor: {scale_factor}")
+        logger.debug("Scaling the object to fit the front plane ZX. Largest dimension: %s. Scale factor: %s", largest_dimension, scale_factor)
         # Apply the scale to the object
         obj.scale = (scale_factor, scale_factor, scale_factor)
 
 def create_icons_folder():
-    """Create the 'Icons' folder and subfolders for each resolution."""
+    """Create the 'Icons' folder next to the Blender file if it doesn't exist yet."""
     base_dir = os.path.dirname(bpy.data.filepath)  # Directory of the Blender file
     icons_dir = os.path.join(base_dir, "Icons")
     
-    if not os.path.exists(icons_dir):
-        os.makedirs(icons_dir)
-        print(f"Created 'Icons' folder at: {icons_dir}")
+    os.makedirs(icons_dir, exist_ok=True)
+    print(f"Saving icons to 'Icons' folder at: {icons_dir}")
     
     return icons_dir
 
-def setup_render_settings(resolution):
-    """Set up render settings for the given resolution."""
-    bpy.context.scene.render.resolution_x = resolution
-    bpy.context.scene.render.resolution_y = resolution
+def setup_render_settings_constants():
+    """Set up the render settings that are the same for every render."""
     bpy.context.scene.render.image_settings.file_format = 'PNG'
     bpy.context.scene.render.image_settings.color_mode = 'RGBA'  # For transparent background
+    bpy.context.scene.render.image_settings.color_depth = '8'  # The downscaled icons are read back as 8-bit sRGB bytes
     bpy.context.scene.render.film_transparent = True  # Enable transparent background
-    print(f"Render settings updated for resolution: {resolution}x{resolution}")
+    bpy.context.scene.render.resolution_percentage = 100  # The downscaled icons expect the full master resolution
+    bpy.context.scene.render.image_settings.compression = 15  # Blender's default, maps to zlib level 1 like the downscaled icons
+    
+    # Keep the scene data (BVH, shaders, textures) between renders, only the visible target mesh changes
+    bpy.context.scene.render.use_persistent_data = True
+    logger.debug("Render settings updated for transparent PNG output.")
 
-def render_object(obj, resolution, output_dir):
-    """Render an object at the specified resolution and save it to the output directory."""
-    # Hide all other objects except the object and lights
+def setup_render_devices():
+    """Let Cycles render on all the GPUs of the first available compute backend, keeping the CPU if there is none."""
+    if "cycles" not in bpy.context.preferences.addons:
+        return
+    
+    # Device preferences are not saved with the scene, so every worker process sets them up itself
+    prefs = bpy.context.preferences.addons["cycles"].preferences
+    for compute_device_type in GPU_COMPUTE_DEVICE_TYPES:
+        devices = prefs.get_devices_for_type(compute_device_type)
+        gpu_devices = [device for device in devices if device.type == compute_device_type]
+        if gpu_devices:
+            prefs.compute_device_type = compute_device_type
+            
+            # The list also contains the CPU, leave it off so parallel workers don't all compete for the cores
+            for device in devices:
+                device.use = device.type == compute_device_type
+            bpy.context.scene.cycles.device = 'GPU'
+            print(f"Rendering with {compute_device_type} on {len(gpu_devices)} GPU(s).")
+            return
+    
+    print("No GPU found for Cycles, rendering on the CPU.")
+
+def hide_non_target_objects(target_meshes):
+    """Hide every object except the lights and the target meshes from the render, once before rendering."""
+    target_set = set(target_meshes)
     for other_obj in bpy.context.scene.objects:
-        if other_obj != obj and other_obj.type != 'LIGHT':
-            other_obj.hide_render = True
-        else:
+        if other_obj.type == 'LIGHT':
             other_obj.hide_render = False
+        elif other_obj not in target_set:
+            other_obj.hide_render = True
+
+def render_object(obj, resolution, output_dir, target_meshes):
+    """Render an object at the specified resolution and save it to the output directory."""
+    # Only show this object among the target meshes, everything else was hidden up front
+    for target_obj in target_meshes:
+        target_obj.hide_render = target_obj != obj
     
     # Set the output file path
     output_path = os.path.join(output_dir, f"{resolution}.png")
     bpy.context.scene.render.filepath = output_path
     
     # Render the object
-    print(f"Rendering {obj.name} at {resolution}x{resolution}...")
+    logger.debug("Rendering %s at %dx%d...", obj.name, resolution, resolution)
     bpy.ops.render.render(write_still=True)
-    print(f"Saved render to: {output_path}")
+    logger.debug("Saved render to: %s", output_path)
+    return output_path
 
+def _png_chunk(chunk_type, data):
+    """Pack a PNG chunk: length, type, data and CRC."""
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+def write_png(path, pixels, compress_level=PNG_COMPRESS_LEVEL):
+    """Write a (height, width, 4) uint8 RGBA array to a PNG file using the given zlib compression level."""
+    height, width, _ = pixels.shape
+    
+    # Every scanline is prefixed with filter type 0 (no filtering)
+    scanlines = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = pixels.reshape(height, width * 4)
+    
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)  # 8-bit RGBA, no interlacing
+    with open(path, "wb") as png_file:
+        png_file.write(PNG_SIGNATURE)
+        png_file.write(_png_chunk(b"IHDR", header))
+        png_file.write(_png_chunk(b"IDAT", zlib.compress(scanlines.tobytes(), compress_level)))
+        png_file.write(_png_chunk(b"IEND", b""))
+
+def _save_mipmap_chain(pixels, output_dir):
+    """Downscale the master pixels level by level, each from the previous one with a box filter, and write every level as a PNG."""
+    for resolution in RESOLUTIONS[1:]:
+        # Average each factor x factor block with rounding, in integers to avoid a float copy of the image
+        factor = pixels.shape[0] // resolution
+        blocks = pixels.reshape(resolution, factor, resolution, factor, 4).astype(np.uint32)
+        
+        # Weight the colours by alpha so the transparent (black) background doesn't darken the edges
+        alpha = blocks[..., 3:]
+        color_sums = (blocks[..., :3] * alpha).sum(axis=(1, 3))
+        alpha_sums = alpha.sum(axis=(1, 3))
+        
+        pixels = np.empty((resolution, resolution, 4), dtype=np.uint8)
+        pixels[..., :3] = (color_sums + alpha_sums // 2) // np.maximum(alpha_sums, 1)  # Fully transparent blocks stay black
+        pixels[..., 3:] = (alpha_sums + factor * factor // 2) // (factor * factor)
+        
+        output_path = os.path.join(output_dir, f"{resolution}.png")
+        write_png(output_path, pixels)
+        logger.debug("Saved downscaled icon to: %s", output_path)
+
+def save_downscaled_icons(master_path, output_dir, executor):
+    """Downscale the master render to each of the smaller resolutions and save them to the output directory.
+    The icons are written on one of the executor's threads, the returned future completes once they are saved."""
+    # Read the master render once as 8-bit RGBA, Blender stores the rows bottom to top
+    master_image = bpy.data.images.load(master_path)
+    width, height = master_image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    master_image.pixels.foreach_get(pixels)
+    pixels = np.round(pixels * 255).astype(np.uint8).reshape(height, width, 4)[::-1]
+    bpy.data.images.remove(master_image)
+    
+    # Resizing and PNG encoding don't touch bpy, so the whole chain can be written on another thread
+    return executor.submit(_save_mipmap_chain, pixels, output_dir)
 
 def ensure_object_mode():
     """Ensure Blender is in Object Mode."""
@@ -107,39 +213,40 @@ def ensure_object_mode():
 
 def standardize_object(obj):
     """Standardize the scale, origin, and location of an object."""
-    print(f"Processing object: {obj.name}")
-    
-    # Print initial transformation values
-    print(f"Rotation: {obj.rotation_euler}")
-    print(f"Scale: {obj.scale}")
-    
-    # Select the object and make it active
-    bpy.context.view_layer.objects.active = obj
-    obj.select_set(True)
-    
-    # Apply the scale
-    print("Applying scale...")
-    bpy.ops.object.transform_apply(scale=True)
-    
-    # Apply the rotation
-    print("Applying rotation...")
-    bpy.ops.object.transform_apply(rotation=True)
-    
-    # Set the origin to the center of the geometry
-    print("Setting origin to center of geometry...")
-    bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY', center='BOUNDS')
+    logger.debug("Processing object: %s", obj.name)
+    
+    # Log initial transformation values, reading them is only worth it when debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Rotation: %s", obj.rotation_euler)
+        logger.debug("Scale: %s", obj.scale)
+    
+    # Apply the scale and rotation directly to the mesh data, keeping only the location on the object
+    logger.debug("Applying scale and rotation...")
+    if obj.data.users > 1:
+        # Linked duplicates share their mesh, give this object its own copy so it is only transformed once
+        obj.data = obj.data.copy()
+    basis = obj.matrix_basis.copy()
+    obj.data.transform(basis.to_3x3().to_4x4(), shape_keys=True)
+    obj.matrix_basis = mathutils.Matrix.Translation(basis.translation)
+    
+    # Update the object once so its bounding box and world matrix reflect the applied transforms
+    bpy.context.view_layer.update()
+    bounds_min, bounds_max = get_world_bounds(obj)
+    
+    # Move the geometry so its bounds are centered on the origin
+    logger.debug("Setting origin to center of geometry...")
+    world_center = (bounds_min + bounds_max) / 2
+    local_center = obj.matrix_world.inverted() @ mathutils.Vector(world_center.tolist())  # Also correct for parented objects
+    obj.data.transform(mathutils.Matrix.Translation(-local_center), shape_keys=True)
     
     # Clear the location (move the origin to (0, 0, 0))
-    print("Clearing location...")
-    bpy.ops.object.location_clear(clear_delta=False)
+    logger.debug("Clearing location...")
+    obj.location = (0, 0, 0)
     
-    # Scale to fit in view
-    print("Scaling object to fit camera...")
-    scale_object_to_fit_camera(obj)
-    
-    # Deselect the object
-    obj.select_set(False)
-    print("-" * 40)
+    # Scale to fit in view, the centered bounds are known without another update
+    logger.debug("Scaling object to fit camera...")
+    scale_object_to_fit_camera(obj, bounds=(bounds_min - world_center, bounds_max - world_center))
+    logger.debug("-" * 40)
 
 def create_setup_collection():
     """Create or get the 'Setup' collection and ensure it exists."""
@@ -160,8 +267,8 @@ def add_camera_to_collection(collection):
     collection.objects.link(camera_object)
     
     # Position the camera
-    camera_object.location = (0, -4, 0)  # Adjust as needed
-    camera_object.rotation_euler = (mathutils.Euler((math.radians(90), 0, 0), 'XYZ'))  # Pointing towards the origin
+    camera_object.location = CAM_LOC
+    camera_object.rotation_euler = CAM_ROT
     return camera_object
 
 def lights_exist():
@@ -169,11 +276,12 @@ def lights_exist():
     return any(obj.type == 'LIGHT' for obj in bpy.context.view_layer.objects)
 
 def add_3_point_lighting_to_collection(collection):
-    """Add a 3-point lighting system to the specified collection if no lights exist."""
+    """Add a 3-point lighting system to the specified collection if no lights exist.
+    Returns the new light objects, or None if the light setup was skipped."""
     
     if lights_exist():
         print("Lights already exist in the scene. Skipping light setup.")
-        return []
+        return None
     
     print("Adding 3-point lighting...")
     
@@ -203,19 +311,33 @@ def add_3_point_lighting_to_collection(collection):
 def ensure_unique_in_collection(collection, objects):
     """Ensure the given objects are only in the specified collection."""
     for obj in objects:
-        for coll in obj.users_collection:
+        # Snapshot the collections once, unlinking while iterating would change the list
+        users_collection = obj.users_collection[:]
+        if len(users_collection) == 1 and users_collection[0] == collection:
+            continue  # Already only in the target collection
+        
+        for coll in users_collection:
             if coll != collection:
                 coll.objects.unlink(obj)
     print("Ensured objects are unique to the 'Setup' collection.")
 
-def main():
-    """Main function to standardize objects and set up the scene."""
+def get_target_meshes():
+    """Return the meshes in the "Target" collection."""
+    target_collection = bpy.data.collections["Target"]
+    return [obj for obj in target_collection.objects if obj.type == 'MESH']
+
+def setup_scene():
+    """Set up the camera and lights and standardize the objects in the "Target" collection.
+    Returns the 'Icons' folder and the target meshes, or None if there is no "Target" collection."""
     ensure_object_mode()
     
     # Check if the "Target" collection exists
     if "Target" not in bpy.data.collections:
         print("Collection 'Target' does not exist.")
-        return
+        return None
+    
+    # Collect the meshes once, both the standardize and the render pass use them
+    target_meshes = get_target_meshes()
     
     # Create or get the "Setup" collection
     setup_collection = create_setup_collection()
@@ -227,8 +349,14 @@ def main():
     # Set the camera as the active camera
     bpy.context.scene.camera = camera_object
     
-    # Force a scene update to ensure that the lights are fully applied and rendered
-    bpy.context.view_layer.update()  # This forces the scene to update
+    # Set up the render settings shared by every render, they are saved along with the scene for the workers
+    setup_render_settings_constants()
+    
+    # Force a scene update to ensure that new lights are fully applied and rendered
+    if lights is not None:
+        bpy.context.view_layer.update()  # This forces the scene to update
+    else:
+        lights = ()
     
     # Ensure the camera and lights are only in the "Setup" collection
     ensure_unique_in_collection(setup_collection, [camera_object] + list(lights))
@@ -238,27 +366,87 @@ def main():
     # Create the 'Icons' folder and subfolders
     icons_dir = create_icons_folder()
     
-    # Get the "Target" collection
-    target_collection = bpy.data.collections["Target"]
-    
     # Standardize objects in the "Target" collection
-    for obj in target_collection.objects:
-        if obj.type == 'MESH':  # Ensure it's a mesh
-            standardize_object(obj)
-    
-    # Iterate through all objects in the "Target" collection
-    for obj in target_collection.objects:
-        if obj.type == 'MESH':  # Ensure it's a mesh
-            print(f"Processing object: {obj.name}")
+    for obj in target_meshes:
+        standardize_object(obj)
+    
+    return icons_dir, target_meshes
+
+def render_target_objects(icons_dir, target_meshes, worker_index=0, worker_count=1):
+    """Render the meshes from the "Target" collection to the icons folder.
+    When running as one of several workers, only every `worker_count`-th mesh starting at `worker_index` is rendered."""
+    # Only the largest resolution is rendered, the smaller icons are downscaled from it
+    bpy.context.scene.render.resolution_x = bpy.context.scene.render.resolution_y = RESOLUTIONS[0]
+    setup_render_devices()
+    hide_non_target_objects(target_meshes)
+    
+    # Create the icon subfolders for this worker's share of the objects up front
+    worker_meshes = target_meshes[worker_index::worker_count]
+    for obj in worker_meshes:
+        os.makedirs(os.path.join(icons_dir, obj.name), exist_ok=True)
+    
+    # The downscaled icons of each object are written in the background while the next one renders
+    with ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1)) as executor:
+        pending_writes = []
+        
+        # Iterate through this worker's share of the objects in the "Target" collection
+        for obj in worker_meshes:
+            logger.debug("Processing object: %s", obj.name)
             
-            # Render the object at each resolution
-            for res in RESOLUTIONS:
-                icon_dir = os.path.join(icons_dir, obj.name)
-                setup_render_settings(res)
-                render_object(obj, res, icon_dir)
+            # Render the object once and derive the remaining resolutions from that render
+            icon_dir = os.path.join(icons_dir, obj.name)
+            master_path = render_object(obj, RESOLUTIONS[0], icon_dir, target_meshes)
+            pending_writes.append(save_downscaled_icons(master_path, icon_dir, executor))
             
-            print("-" * 40)
+            logger.debug("-" * 40)
+        
+        for future in pending_writes:
+            future.result()  # Re-raise any error from the worker threads
 
+def parse_script_args():
+    """Parse the arguments passed to the script after Blender's '--' separator."""
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    
+    parser = argparse.ArgumentParser(prog="icons_generator.py")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--setup", metavar="BLEND_FILE",
+                      help="Set up the scene, save it to BLEND_FILE and exit without rendering.")
+    mode.add_argument("--worker", nargs=2, type=int, metavar=("INDEX", "COUNT"),
+                      help="Render every COUNT-th object starting at INDEX from a scene saved with --setup.")
+    parser.add_argument("--verbose", action="store_true", help="Log the per-object progress.")
+    args = parser.parse_args(argv)
+    
+    if args.worker and not 0 <= args.worker[0] < args.worker[1]:
+        parser.error("--worker INDEX must be at least 0 and smaller than COUNT")
+    return args
+
+def main():
+    """Main function to standardize objects, set up the scene and render the icons."""
+    args = parse_script_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    
+    if args.worker:
+        # The scene was already set up and saved by the setup pass, only render this worker's objects
+        worker_index, worker_count = args.worker
+        render_target_objects(create_icons_folder(), get_target_meshes(), worker_index, worker_count)
+        print(f"Worker {worker_index} finished rendering.")
+        return
+    
+    scene_setup = setup_scene()
+    if scene_setup is None:
+        if args.setup:
+            sys.exit(1)  # Fail the setup pass so the launcher doesn't start workers on a missing or stale scene
+        return
+    icons_dir, target_meshes = scene_setup
+    
+    if args.setup:
+        # Save a copy of the standardized scene for the render workers
+        bpy.ops.wm.save_as_mainfile(filepath=args.setup, copy=True)
+        print(f"Saved standardized scene to: {args.setup}")
+        return
+    
+    render_target_objects(icons_dir, target_meshes)
     print("Rendering complete! All icons saved in the 'Icons' folder.")
 
 # Run the script
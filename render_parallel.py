@@ -0,0 +1,60 @@
+import argparse
+import multiprocessing
+import os
+import subprocess
+
+# The icon generator script, run inside every Blender process
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "icons_generator.py")
+
+def blender_command(blender, blend_file, *script_args):
+    """Build the command line that runs the icon generator script in a headless Blender."""
+    return [blender, "-b", blend_file, "--python-exit-code", "1", "-P", SCRIPT_PATH, "--", *script_args]
+
+def setup_scene(blender, blend_file, standardized_file):
+    """Run the setup pass once, saving the standardized scene for the render workers."""
+    print(f"Setting up the scene from {blend_file}...")
+    subprocess.run(blender_command(blender, blend_file, "--setup", standardized_file), check=True)
+
+def do_calls(worker_index, worker_count, blender, standardized_file):
+    """Render one worker's share of the objects, pinned to its own GPU."""
+    # Each GPU backend has its own visibility variable, Metal has none and always sees every GPU
+    env = os.environ.copy()
+    env["CUDA_VISIBLE_DEVICES"] = str(worker_index)  # CUDA and OptiX
+    env["HIP_VISIBLE_DEVICES"] = str(worker_index)
+    env["ONEAPI_DEVICE_SELECTOR"] = f"level_zero:{worker_index}"
+
+    print(f"Starting worker {worker_index} of {worker_count}...")
+    subprocess.run(blender_command(blender, standardized_file, "--worker", str(worker_index), str(worker_count)),
+                   env=env, check=True)
+
+def main():
+    """Set up the scene once, then render the icons with one headless Blender process per GPU."""
+    parser = argparse.ArgumentParser(description="Render the icons with several headless Blender processes.")
+    parser.add_argument("blend_file", help="Blender file containing the 'Target' collection.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of Blender processes, usually one per GPU.")
+    parser.add_argument("--blender", default="blender", help="Path to the Blender executable.")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    # The standardized scene is saved next to the original so the icons end up in the same 'Icons' folder
+    blend_file = os.path.abspath(args.blend_file)
+    standardized_file = os.path.splitext(blend_file)[0] + "_standardized.blend"
+
+    # Remove the scene left over from an earlier run so it can never be rendered by mistake
+    if os.path.exists(standardized_file):
+        os.remove(standardized_file)
+
+    setup_scene(args.blender, blend_file, standardized_file)
+    if not os.path.exists(standardized_file):
+        raise SystemExit(f"Setup did not save the standardized scene to {standardized_file}.")
+
+    with multiprocessing.Pool(args.workers) as pool:
+        pool.starmap(do_calls, [(index, args.workers, args.blender, standardized_file)
+                                for index in range(args.workers)])
+
+    print("Rendering complete! All icons saved in the 'Icons' folder.")
+
+# Run the script
+if __name__ == "__main__":
+    main()
\ No newline at end of file